@@ -1,21 +1,41 @@
 import streamlit as st
 import time
-import pandas as pd
-import pytz
 from datetime import datetime, timedelta
-from kite_manager import KiteManager
-from wallet_manager import WalletManager
 
 # --- CONFIGURATION ---
 st.set_page_config(page_title="PaperTrading Sim", layout="wide")
 REFRESH_RATE = 5 # seconds
 
+# Custom CSS for compact look
+CUSTOM_CSS = """
+    <style>
+    div[data-testid="column"] {
+        text-align: center;
+    }
+    div.stButton > button:first-child {
+        width: 100%;
+        border-radius: 5px;
+        border: 1px solid #4CAF50;
+    }
+    </style>
+    """
+
 # --- INIT MANAGERS ---
 # We use @st.cache_resource for the KiteManager to persist connection/instruments across reruns
 @st.cache_resource
 def get_kite_manager():
     return KiteManager()
 
+# Market data is cached for one refresh window so widget-driven reruns (radio, qty, popover)
+# hit memory instead of the broker. The leading underscore tells Streamlit not to hash the manager.
+@st.cache_data(ttl=REFRESH_RATE, show_spinner=False)
+def fetch_indices(_kite):
+    return _kite.get_indices()
+
+@st.cache_data(ttl=REFRESH_RATE, show_spinner=False)
+def fetch_option_chain(_kite, symbol, expiry_date, spot_price=None):
+    return _kite.get_option_chain(symbol, expiry_date, spot_price=spot_price)
+
 
 # --- LOGIN SYSTEM ---
 if 'username' not in st.session_state:
@@ -37,6 +57,17 @@ if not st.session_state.username:
     login()
     st.stop() # Stop execution here if not logged in
 
+# Heavy imports (pandas/numpy/kiteconnect) are deferred until after login so the
+# login screen paints without paying for them
+import numpy as np
+import pandas as pd
+from kite_manager import KiteManager
+from market_time import IST
+from wallet_manager import WalletManager
+
+# One clock read per full rerun; the fragments below take their own per tick
+NOW = datetime.now(IST)
+
 # --- MAIN APP (LOGGED IN) ---
 username = st.session_state.username
 kite = get_kite_manager()
@@ -48,20 +79,24 @@ st.sidebar.markdown(f"User: **{username}**")
 if st.sidebar.button("Logout"):
     st.session_state.username = None
     st.session_state.positions = [] # Clear positions from session
+    st.session_state.positions_idx = {}
+    st.session_state.pop('total_pnl', None)
     st.rerun()
 
 st.sidebar.divider()
 if st.sidebar.button("⚠️ Reset Account", key="reset_acc", type="primary"):
-    wallet.reset_account()
-    st.sidebar.success("Account Reset!")
-    time.sleep(1)
-    st.rerun()
+    success, msg = wallet.reset_account()
+    if success:
+        st.session_state.pop('total_pnl', None)
+        st.sidebar.success("Account Reset!")
+        time.sleep(1)
+        st.rerun()
+    else:
+        st.sidebar.error(msg)
 
 
 # --- MARKET HOURS LOGIC ---
-def is_market_open():
-    tz = pytz.timezone('Asia/Kolkata')
-    now = datetime.now(tz)
+def is_market_open(now):
     # Market: 09:15 to 15:30
     start = now.replace(hour=9, minute=15, second=0, microsecond=0)
     end = now.replace(hour=15, minute=30, second=0, microsecond=0)
@@ -73,7 +108,7 @@ def is_market_open():
 st.sidebar.title("Configuration")
 # Expiry Selector - In real app, we'd fetch actual expiry dates from instruments
 # Here we just pick next upcoming Thursdays roughly or let user pick date
-today = datetime.now().date()
+today = NOW.date()
 # Find next thursday
 days_ahead = (3 - today.weekday() + 7) % 7
 next_thursday = today + timedelta(days=days_ahead)
@@ -81,255 +116,248 @@ expiry_date = st.sidebar.date_input("Select Expiry Date", next_thursday)
 
 auto_refresh = st.sidebar.checkbox("Auto-Refresh (5s)", value=True)
 
-# --- HEADER METRICS ---
-st.title("PaperTrading - Option Chain Simulator")
+# Fragments below re-run on their own timer, so only the live sections refresh each tick
+refresh_every = REFRESH_RATE if auto_refresh else None
 
-col1, col2, col3, col4 = st.columns(4)
-indices = kite.get_indices() 
+# Injected outside the fragments, so timer ticks never resend it. It still has to be
+# emitted on every full rerun: Streamlit drops elements a run doesn't re-emit.
+st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
 
-market_status = "LIVE 🟢" if is_market_open() else "CLOSED 🔴"
 
-# Metrics
-# Metrics
-nifty_data = indices.get('NSE:NIFTY 50', {})
-bank_data = indices.get('NSE:NIFTY BANK', {})
+def get_index_quote(indices, key):
+    """Returns (last_price, change vs previous close) for an index from the quote dict."""
+    data = indices.get(key, {})
+    val = data.get('last_price', 0)
+    close = data.get('ohlc', {}).get('close', val)
+    return val, val - close
 
-nifty_val = nifty_data.get('last_price', 0)
-nifty_close = nifty_data.get('ohlc', {}).get('close', nifty_val)
-nifty_change = nifty_val - nifty_close
+def get_ltp_map(df):
+    """Builds the instrument -> LTP dict used to mark positions."""
+    strikes = df['Strike Price'].astype(int).to_numpy()
+    ce = df['CE Price'].to_numpy()
+    pe = df['PE Price'].to_numpy()
+    current_prices = dict(zip([f"{s} CE" for s in strikes], ce))
+    current_prices.update(zip([f"{s} PE" for s in strikes], pe))
+    return current_prices
 
-bank_val = bank_data.get('last_price', 0)
-bank_close = bank_data.get('ohlc', {}).get('close', bank_val)
-bank_change = bank_val - bank_close
+def fetch_nifty_chain(kite, expiry_date):
+    """Returns (spot, chain) for NIFTY, centring the chain on the spot from the cached header quote."""
+    nifty_val, _ = get_index_quote(fetch_indices(kite), 'NSE:NIFTY 50')
+    return nifty_val, fetch_option_chain(kite, "NIFTY", expiry_date, spot_price=nifty_val)
 
-col1.metric("NIFTY 50", f"{nifty_val:.2f}", f"{nifty_change:.2f}")
-col2.metric("BANK NIFTY", f"{bank_val:.2f}", f"{bank_change:.2f}")
-col3.metric("Wallet Balance", f"₹{wallet.get_balance():,.2f}")
-# We will render P&L after fetching data
-pnl_placeholder = col4.empty()
-pnl_placeholder.metric("Day P&L", f"₹{wallet.get_realized_pnl():,.2f}")
 
-st.info(f"Market Status: **{market_status}**")
+# --- HEADER METRICS ---
+st.title("PaperTrading - Option Chain Simulator")
 
+@st.fragment(run_every=refresh_every)
+def render_header(kite, wallet):
+    now = datetime.now(IST)
+    col1, col2, col3, col4 = st.columns(4)
+    indices = fetch_indices(kite)
 
-# --- POSITIONS SECTION ---
-pos_placeholder = st.empty()
-if st.session_state.positions:
-    with pos_placeholder.container():
-        with st.expander("Active Positions", expanded=True):
-             st.info("Fetching latest prices... (This will update momentarily)")
+    market_status = "LIVE 🟢" if is_market_open(now) else "CLOSED 🔴"
 
+    # Metrics
+    nifty_val, nifty_change = get_index_quote(indices, 'NSE:NIFTY 50')
+    bank_val, bank_change = get_index_quote(indices, 'NSE:NIFTY BANK')
 
+    col1.metric("NIFTY 50", f"{nifty_val:.2f}", f"{nifty_change:.2f}")
+    col2.metric("BANK NIFTY", f"{bank_val:.2f}", f"{bank_change:.2f}")
+    col3.metric("Wallet Balance", f"₹{wallet.get_balance():,.2f}")
 
-# --- OPTION CHAIN TABLE ---
-st.subheader(f"Option Chain - NIFTY - Expiry: {expiry_date}")
+    # Positions are marked once per tick by render_chain; until it has run, only realized P&L is known
+    total_pnl = st.session_state.get('total_pnl')
+    if total_pnl is None:
+        col4.metric("Day P&L", f"₹{wallet.get_realized_pnl():,.2f}")
+    else:
+        col4.metric("Day P&L", f"₹{total_pnl:,.2f}", delta=f"{total_pnl:,.2f}")
 
-# Fetch Data
-with st.spinner("Fetching Option Chain..."):
-    df = kite.get_option_chain("NIFTY", expiry_date)
+    st.info(f"Market Status: **{market_status}**")
 
-if df.empty:
-    st.warning("No Option Chain Data Available. Check Expiry or Connectivity.")
-else:
-    # --- CUSTOM GRID UI ---
-    # Header: OI | LTP | STRIKE | LTP | OI
-    # Custom CSS for compact look
-    st.markdown("""
-        <style>
-        div[data-testid="column"] {
-            text-align: center;
-        }
-        div.stButton > button:first-child {
-            width: 100%;
-            border-radius: 5px;
-            border: 1px solid #4CAF50;
-        }
-        </style>
-        """, unsafe_allow_html=True)
+render_header(kite, wallet)
+
+
+# --- POSITIONS + OPTION CHAIN ---
+@st.fragment(run_every=refresh_every)
+def render_chain(kite, wallet, expiry_date):
+    now = datetime.now(IST)
+
+    # Fetch Data
+    with st.spinner("Fetching Option Chain..."):
+        # Reuse the spot already fetched for the header instead of quoting it again
+        nifty_val, df = fetch_nifty_chain(kite, expiry_date)
+
+    if df.empty:
+        st.subheader(f"Option Chain - NIFTY - Expiry: {expiry_date}")
+        st.warning("No Option Chain Data Available. Check Expiry or Connectivity.")
+        return
 
-    header = st.columns([1.5, 1.5, 3, 1.5, 1.5])
-    header[0].markdown("**CE OI (L)**")
-    header[1].markdown("**CE LTP**")
-    header[2].markdown("**STRIKE**")
-    header[3].markdown("**PE LTP**")
-    header[4].markdown("**PE OI (L)**")
+    # --- UPDATE P&L WITH LIVE PRICES ---
+    # The only place positions get marked; the header shows the stored total
+    current_prices = get_ltp_map(df)
+    st.session_state.total_pnl = wallet.update_pnl_heatmap(current_prices)
+
+    # --- POSITIONS TABLE ---
+    if st.session_state.positions:
+        with st.expander("Active Positions", expanded=True):
+             # Convert to DF for clearer display & manipulation
+             pos_df = pd.DataFrame(st.session_state.positions)
+             
+             if not pos_df.empty:
+                # CSV Download Button (Top Right of Expander)
+                csv = pos_df.to_csv(index=False).encode('utf-8')
+                st.download_button(
+                    label="📄 Export CSV",
+                    data=csv,
+                    file_name='open_positions.csv',
+                    mime='text/csv',
+                    key='download_pos'
+                )
+
+             # Show recent trades first (Reverse order) as one editable table;
+             # ticking "Close" on a row squares off its full quantity.
+             view = pos_df.iloc[::-1].set_index('instrument')
+             if 'current_price' not in view:
+                 view['current_price'] = view['avg_price']
+             if 'unrealized_pnl' not in view:
+                 view['unrealized_pnl'] = 0.0
+             view = pd.DataFrame({
+                 "Type": view['type'],
+                 "Qty": view['qty'],
+                 "Avg": view['avg_price'],
+                 "LTP": view['current_price'].fillna(view['avg_price']), # Fallback to avg if missing
+                 "P&L": view['unrealized_pnl'].fillna(0.0),
+                 "Close": False,
+             })
+             view.index.name = "Instrument"
+
+             styled = view.style.apply(lambda s: np.where(s >= 0, "color: green", "color: red"), subset=["P&L"])
+
+             # Versioned key so a processed "Close" tick doesn't carry over to the next table
+             if 'pos_editor_ver' not in st.session_state:
+                 st.session_state.pos_editor_ver = 0
+             edited = st.data_editor(
+                 styled,
+                 column_config={
+                     "Avg": st.column_config.NumberColumn(format="%.2f"),
+                     "LTP": st.column_config.NumberColumn(format="%.2f"),
+                     "P&L": st.column_config.NumberColumn(format="%.2f"),
+                     "Close": st.column_config.CheckboxColumn("Close"),
+                 },
+                 disabled=["Instrument", "Type", "Qty", "Avg", "LTP", "P&L"],
+                 use_container_width=True,
+                 key=f"pos_editor_{st.session_state.pos_editor_ver}"
+             )
+
+             to_close = edited[edited['Close']]
+             if not to_close.empty:
+                 errors = []
+                 # Plain numpy arrays: no per-row Series/label lookups in the loop
+                 for inst, qty, ltp in zip(to_close.index.to_numpy(), to_close['Qty'].to_numpy(), to_close['LTP'].to_numpy()):
+                     success, msg = wallet.execute_trade(
+                         "SELL",
+                         inst,
+                         qty, # Close full quantity
+                         ltp,
+                         now=now
+                     )
+                     if not success:
+                         errors.append(f"{inst}: {msg}")
+
+                 st.session_state.total_pnl = wallet.update_pnl_heatmap(current_prices)
+                 st.session_state.pos_editor_ver += 1
+                 if errors:
+                     st.error("\n".join(errors))
+                 else:
+                     st.success(f"Closed {', '.join(to_close.index)}")
+                     time.sleep(0.5)
+                     st.rerun() # Full rerun so the header balance updates too
+
+    # --- OPTION CHAIN TABLE ---
+    st.subheader(f"Option Chain - NIFTY - Expiry: {expiry_date}")
 
     expiry_str = expiry_date.strftime("%d%b").upper()
     
-    # Calculate ATM for highlighting
-    # We fetch spot again or assume it from header logic. Safer to fetch fresh or reuse if simple.
-    # But optimal usage: Re-use nifty_val from header if available, else fetch.
-    current_spot = nifty_val # From header fetching
+    # Calculate ATM for highlighting, re-using the header spot
+    current_spot = nifty_val
     atm_strike = round(current_spot / 50) * 50
 
-    for index, row in df.iterrows():
-
-        c = st.columns([1.5, 1.5, 3, 1.5, 1.5])
-        
-        strike = int(row['Strike Price'])
-        ce_price = row['CE Price']
-        pe_price = row['PE Price']
-        ce_oi = f"{row['CE OI']/100000:.1f}" # Convert to Lakhs
-        pe_oi = f"{row['PE OI']/100000:.1f}"
-
-        # CE Data
-        c[0].markdown(f":blue[{ce_oi}]")
-        c[1].markdown(f"**{ce_price}**")
-
-        # CENTER: STRIKE BUTTON (POPOVER)
-        # Highlight ATM
-        label = f"{strike} ({expiry_str})"
-        btn_type = "primary" if strike == atm_strike else "secondary"
-        
-        # We can't easily style the individual button color without more CSS hacks, 
-        # but we can add an indicator.
-        if strike == atm_strike:
-            label = f"📍 {strike} ({expiry_str})"
-            # Add a visual separator or background? 
-            # Streamlit columns don't support bg color directly without custom html.
-            # We will rely on the verifyable indicator icon.
-        
-        with c[2].popover(label, use_container_width=True):
-
-            st.markdown(f"### Trade {expiry_str} **{strike}**")
-            
-            # Instrument Selection (Outside form for immediate update)
-            # Use columns to make it compact
-            p_col1, p_col2 = st.columns(2)
-            inst_type_sel = p_col1.radio(
-                "Instrument", 
-                ["CE", "PE"], 
-                horizontal=True, 
-                key=f"inst_{strike}",
-                label_visibility="collapsed"
+    # All display formatting is done column-wise up front (no per-row f-strings)
+    strike_int = df['Strike Price'].astype(int)
+    is_atm = (strike_int == atm_strike).to_numpy()
+    strike_lbl = strike_int.astype(str) + f" ({expiry_str})"
+    label = np.where(is_atm, "📍 " + strike_lbl, strike_lbl)
+
+    # Rendered as one dataframe element rather than a columns/markdown grid per strike
+    # Header: OI | LTP | STRIKE | LTP | OI
+    chain_view = pd.DataFrame({
+        "CE OI (L)": (df['CE OI'].fillna(0) / 1e5).round(1).astype(str), # Convert to Lakhs
+        "CE LTP": df['CE Price'],
+        "STRIKE": label,
+        "PE LTP": df['PE Price'],
+        "PE OI (L)": (df['PE OI'].fillna(0) / 1e5).round(1).astype(str),
+    })
+
+    atm_style = np.where(is_atm, "background-color: rgba(76, 175, 80, 0.25); font-weight: bold", "")
+    def highlight_atm(data):
+        return pd.DataFrame(np.repeat(atm_style[:, None], data.shape[1], axis=1),
+                            index=data.index, columns=data.columns)
+
+    st.dataframe(
+        chain_view.style.apply(highlight_atm, axis=None),
+        hide_index=True,
+        use_container_width=True,
+        column_config={
+            "CE LTP": st.column_config.NumberColumn(format="%.2f"),
+            "PE LTP": st.column_config.NumberColumn(format="%.2f"),
+        }
+    )
+
+    # --- TRADE PANEL ---
+    strikes = strike_int.tolist()
+    label_by_strike = dict(zip(strikes, label))
+    default_idx = int(is_atm.argmax()) if is_atm.any() else len(strikes) // 2
+
+    t_col1, t_col2, t_col3 = st.columns([3, 2, 2])
+    strike = t_col1.selectbox(
+        "Strike",
+        strikes,
+        index=default_idx,
+        format_func=label_by_strike.get,
+        key="trade_strike"
+    )
+    # Instrument Selection (Outside form for immediate update)
+    inst_type_sel = t_col2.radio("Instrument", ["CE", "PE"], horizontal=True, key="trade_inst")
+
+    # Determine values based on selection (LTP map was built above for P&L)
+    full_inst = f"{strike} {inst_type_sel}"
+    active_price = current_prices[full_inst]
+
+    t_col3.metric("LTP", f"₹{active_price}")
+
+    # Trade Form
+    with st.form(key="trade_form"):
+        f_col1, f_col2 = st.columns(2)
+        qty = f_col1.number_input("Qty (Lot: 50)", min_value=50, step=50, value=50, key="trade_qty")
+        action = f_col2.radio("Action", ["BUY", "SELL"], horizontal=True, key="trade_act")
+
+        # Submit
+        total_val = qty * active_price
+        submit_txt = f"{action} {full_inst} at ₹{total_val:,.2f}"
+        if st.form_submit_button(submit_txt, use_container_width=True):
+            success, msg = wallet.execute_trade(
+                action,
+                full_inst,
+                qty,
+                active_price,
+                now=now
             )
-            
-            # Determine values based on selection
-            if inst_type_sel == "CE":
-                active_price = ce_price
-                full_inst = f"{strike} CE"
+            if success:
+                st.session_state.total_pnl = wallet.update_pnl_heatmap(current_prices)
+                st.success("Order Executed!")
+                time.sleep(0.5)
+                st.rerun()
             else:
-                active_price = pe_price
-                full_inst = f"{strike} PE"
-                
-            p_col2.metric("LTP", f"₹{active_price}")
-            
-            # Trade Form
-            with st.form(key=f"trade_form_{strike}"):
-                qty = st.number_input("Qty (Lot: 50)", min_value=50, step=50, value=50, key=f"qty_{strike}")
-                action = st.radio("Action", ["BUY", "SELL"], horizontal=True, key=f"act_{strike}")
-                
-                # Submit
-                total_val = qty * active_price
-                submit_txt = f"{action} at ₹{total_val:,.2f}"
-                if st.form_submit_button(submit_txt, use_container_width=True):
-                    success, msg = wallet.execute_trade(
-                        action,
-                        full_inst,
-                        qty,
-                        active_price
-                    )
-                    if success:
-                        st.success("Order Executed!")
-                        time.sleep(0.5)
-                        st.rerun()
-                    else:
-                        st.error(msg)
-                    
-        # PE Data
-        c[3].markdown(f"**{pe_price}**")
-        c[4].markdown(f":blue[{pe_oi}]")
+                st.error(msg)
 
-    # --- UPDATE P&L WITH LIVE PRICES ---
-    # Construct LTP dict from the dataframe we just iterated
-    current_prices = {}
-    for index, row in df.iterrows():
-        s = int(row['Strike Price'])
-        current_prices[f"{s} CE"] = row['CE Price']
-        current_prices[f"{s} PE"] = row['PE Price']
-        
-    total_pnl = wallet.update_pnl_heatmap(current_prices)
-    
-    # Update the Metric at the top
-    pnl_placeholder.metric("Day P&L", f"₹{total_pnl:,.2f}", delta=f"{total_pnl:,.2f}")
-
-    # --- REFRESH POSITIONS TABLE ---
-    # Render the positions table into the placeholder we defined earlier
-    if st.session_state.positions:
-        with pos_placeholder.container():
-            with st.expander("Active Positions", expanded=True):
-                 # Convert to DF for clearer display & manipulation
-                 pos_df = pd.DataFrame(st.session_state.positions)
-                 
-                 if not pos_df.empty:
-                    # CSV Download Button (Top Right of Expander)
-                    csv = pos_df.to_csv(index=False).encode('utf-8')
-                    st.download_button(
-                        label="📄 Export CSV",
-                        data=csv,
-                        file_name='open_positions.csv',
-                        mime='text/csv',
-                        key='download_pos'
-                    )
-
-                 # Custom Header
-                 h_col = st.columns([3, 1, 2, 2, 2, 2, 1.5]) 
-                 h_col[0].markdown("**Instrument**")
-                 h_col[1].markdown("**Type**")
-                 h_col[2].markdown("**Qty**")
-                 h_col[3].markdown("**Avg**")
-                 h_col[4].markdown("**LTP**")
-                 h_col[5].markdown("**P&L**")
-                 h_col[6].markdown("**Action**")
-
-                 # Show recent trades first (Reverse order)
-                 # We can't just reverse the list in-place as it affects session state.
-                 # We create a reversed view.
-                 reversed_positions = list(reversed(st.session_state.positions))
-
-                 for i, pos in enumerate(reversed_positions):
-                     # p_col = st.columns([3, 1, 2, 2, 2, 2, 1.5])
-                     p_container = st.container()
-                     p_col = p_container.columns([3, 1, 2, 2, 2, 2, 1.5])
-                     
-                     inst = pos['instrument']
-                     p_type = pos['type']
-                     qty = pos['qty']
-                     avg = pos['avg_price']
-                     ltp = pos.get('current_price', avg) # Fallback to avg if 0
-                     pnl = pos.get('unrealized_pnl', 0.0)
-                     
-                     p_col[0].text(inst)
-                     p_col[1].text(p_type)
-                     p_col[2].text(qty)
-                     p_col[3].text(f"{avg:.2f}")
-                     p_col[4].text(f"{ltp:.2f}")
-                     
-                     pnl_color = "green" if pnl >= 0 else "red"
-                     p_col[5].markdown(f":{pnl_color}[{pnl:.2f}]")
-                     
-                     # Close Button
-                     # Use 'inst' in key to be safe, 'i' is just row index in this view
-                     if p_col[6].button("Close", key=f"close_btn_{inst}"):
-                         success, msg = wallet.execute_trade(
-                             "SELL",
-                             inst,
-                             qty, # Close full quantity
-                             ltp
-                         )
-                         if success:
-                             st.success(f"Closed {inst}")
-                             time.sleep(0.5)
-                             st.rerun()
-                         else:
-                             st.error(msg)
-                     
-                     st.divider()
-
-
-
-
-# --- AUTO REFRESH LOOP ---
-if auto_refresh:
-    time.sleep(REFRESH_RATE)
-    st.rerun()
+render_chain(kite, wallet, expiry_date)
@@ -1,39 +1,98 @@
 import os
 import pandas as pd
-from kiteconnect import KiteConnect
 from dotenv import load_dotenv
 import datetime
+import glob
 import random
+import tempfile
+import threading
+import time
+from market_time import IST
 
 load_dotenv()
 
+# OI only updates upstream every few minutes, so the heavy quote() call is throttled
+OI_REFRESH_SECS = 180
+
+# Chain windows (and their ticker subscriptions) nobody has viewed for this long are dropped
+WINDOW_IDLE_SECS = 60
+
 class KiteManager:
     def __init__(self):
         self.api_key = os.getenv("KITE_API_KEY")
         self.access_token = os.getenv("KITE_ACCESS_TOKEN")
-        self.kite = KiteConnect(api_key=self.api_key)
+        self.kite = None
         
-        # Set access token if available
+        # Only pull in kiteconnect when we'll actually talk to Zerodha (mock mode skips it)
         if self.access_token:
+            from kiteconnect import KiteConnect
+            self.kite = KiteConnect(api_key=self.api_key)
             self.kite.set_access_token(self.access_token)
 
         # Cache instruments to avoid heavy API calls every refresh
         self.instruments_list = None
+        self.inst_idx = None # instruments indexed by (name, expiry) for fast chain lookups
         self.use_mock = False
+
+        # OI cache (token -> oi), refreshed at most every OI_REFRESH_SECS
+        self.oi_cache = {}
+        self.oi_fetched_at = 0.0
+
+        # Live LTPs pushed by the KiteTicker websocket (token -> tick); REST is only a fallback
+        self.ticks = {}
+        self.ticker = None
+        self.subscribed = set() # always the tokens of the windows in chain_token_cache
+        self.sub_lock = threading.Lock() # guards the window caches, subscribed + ticker creation across threads
+
+        # (symbol, expiry, min_strike, max_strike) -> (tokens, strike/token template), and when each was last viewed
+        self.chain_token_cache = {}
+        self.window_used = {}
         
         if not self.access_token:
             print("Warning: No Access Token found. Switching to Mock Mode.")
             self.use_mock = True
         
+    def _instruments_cache_path(self):
+        # One file per trading day (IST, whatever the server's zone); the master list doesn't change intraday
+        return os.path.join(tempfile.gettempdir(), f"instruments_{datetime.datetime.now(IST).date():%Y%m%d}.parquet")
+
+    def _prune_instruments_cache(self, keep):
+        """Deletes earlier days' instrument files so the temp dir doesn't collect one per day."""
+        for old in glob.glob(os.path.join(tempfile.gettempdir(), "instruments_*.parquet")):
+            if old != keep:
+                try:
+                    os.remove(old)
+                except OSError as e:
+                    print(f"Error removing old instruments cache {old}: {e}")
+
     def _fetch_instruments(self):
-        """Fetches and caches the master instrument list from Zerodha."""
+        """Fetches and caches the master instrument list from Zerodha (in memory + daily parquet on disk)."""
         if self.use_mock:
             return pd.DataFrame() # Mock implementations don't need this usually
 
         if self.instruments_list is None:
+            path = self._instruments_cache_path()
+            df = None
+            if os.path.exists(path):
+                try:
+                    df = pd.read_parquet(path)
+                except Exception as e:
+                    print(f"Error reading cached instruments: {e}. Re-fetching.")
+
             try:
-                print("Fetching master instrument list... (This happens once)")
-                self.instruments_list = pd.DataFrame(self.kite.instruments("NFO"))
+                if df is None:
+                    print("Fetching master instrument list... (This happens once a day)")
+                    df = pd.DataFrame(self.kite.instruments("NFO"))
+                    try:
+                        df.to_parquet(path)
+                        self._prune_instruments_cache(path)
+                    except Exception as e:
+                        print(f"Error caching instruments to disk: {e}")
+                df['expiry'] = pd.to_datetime(df['expiry']).dt.date
+                df['instrument_type'] = df['instrument_type'].astype('category')
+                self.instruments_list = df
+                # Sorted (name, expiry) index turns per-refresh filtering into an index probe
+                self.inst_idx = df.set_index(['name', 'expiry']).sort_index()
             except Exception as e:
                 print(f"Error fetching instruments: {e}. Switching to Mock.")
                 self.use_mock = True
@@ -52,16 +111,18 @@ class KiteManager:
             print(f"Error fetching spot price: {e}")
             return 24000.0 # Fallback
 
-    def get_option_chain(self, symbol="NIFTY", expiry_date=None, depth=10):
+    def get_option_chain(self, symbol="NIFTY", expiry_date=None, depth=10, spot_price=None):
         """
         Fetches option chain centered around ATM.
+        Pass spot_price if the caller already has it to skip an extra quote round-trip.
         """
         if self.use_mock:
             return self._get_mock_option_chain(symbol, expiry_date)
 
-        # 1. Get Spot Price
-        spot_symbol = "NSE:NIFTY 50" if symbol == "NIFTY" else "NSE:NIFTY BANK"
-        spot_price = self.get_spot_price(spot_symbol)
+        # 1. Get Spot Price (only if the caller didn't supply one)
+        if not spot_price:
+            spot_symbol = "NSE:NIFTY 50" if symbol == "NIFTY" else "NSE:NIFTY BANK"
+            spot_price = self.get_spot_price(spot_symbol)
         
         # 2. Calculate ATM Strike
         step = 50 if symbol == "NIFTY" else 100
@@ -71,67 +132,170 @@ class KiteManager:
         min_strike = atm_strike - (depth * step)
         max_strike = atm_strike + (depth * step)
 
-        # 4. Filter Master Instrument List
+        # 4. Resolve tokens for this window (memoized; tokens don't change intraday)
+        expiry = pd.to_datetime(expiry_date).date()
+        key = (symbol, expiry, min_strike, max_strike)
+        chain = self.chain_token_cache.get(key)
+        if chain is None:
+            chain = self._build_chain_template(symbol, expiry, min_strike, max_strike)
+            if chain is None:
+                return self._get_mock_option_chain(symbol, expiry_date)
+        tokens, template = chain
+
+        # 5. Live Prices from the websocket (REST ltp() while it's down or warming up) and OI (throttled quote())
+        self._subscribe(key, chain)
+        try:
+            ltps = self._tick_ltps(tokens) or self._fetch_ltps(tokens)
+            ois = self._fetch_ois(tokens)
+        except Exception as e:
+            print(f"Error fetching quotes: {e}")
+            return self._get_mock_option_chain(symbol, expiry_date)
+
+        # 6. Merge Live Data into the cached strike template (Call vs Put)
+        return pd.DataFrame({
+            'Strike Price': template.index.to_numpy(),
+            'CE Price': template['CE'].map(ltps).to_numpy(),
+            'CE OI': template['CE'].map(ois).to_numpy(),
+            'PE Price': template['PE'].map(ltps).to_numpy(),
+            'PE OI': template['PE'].map(ois).to_numpy(),
+        })
+
+    def _build_chain_template(self, symbol, expiry, min_strike, max_strike):
+        """
+        Filters the master list once for a chain window.
+        Returns (tokens, template) where template maps strike -> CE/PE token, or None if nothing matches.
+        """
         df = self._fetch_instruments()
         
         if df.empty:
-            return self._get_mock_option_chain(symbol, expiry_date)
+            return None
 
-        # Filter 1: Name (e.g., NIFTY) and Segment
-        mask_symbol = df['name'] == symbol
-        # Filter 2: Expiry
-        if isinstance(expiry_date, (datetime.date, datetime.datetime)):
-            expiry_date = expiry_date
-        else:
-            # parsing logic if string
-             pass
-             
-        mask_expiry = df['expiry'] == pd.to_datetime(expiry_date).date()
-        # Filter 3: Strike Range
-        mask_strike = (df['strike'] >= min_strike) & (df['strike'] <= max_strike)
-
-        filtered_df = df[mask_symbol & mask_expiry & mask_strike].copy()
+        # Filter 1: Name (e.g., NIFTY) + Expiry via the (name, expiry) index
+        try:
+            sub = self.inst_idx.loc[[(symbol, expiry)]]
+        except KeyError:
+            sub = self.inst_idx.iloc[0:0]
+
+        # Filter 2: Strike Range on the already-narrow slice
+        filtered_df = sub[sub['strike'].between(min_strike, max_strike)]
         
         if filtered_df.empty:
             print("No instruments found for this criteria.")
-            return self._get_mock_option_chain(symbol, expiry_date)
+            return None
 
-        # 5. Fetch Live Quotes for these instruments
-        tokens = filtered_df['instrument_token'].tolist()
-        try:
-            live_data = self.kite.quote(tokens)
-        except Exception as e:
-            print(f"Error fetching quotes: {e}")
-            return self._get_mock_option_chain(symbol, expiry_date)
+        # Pivot tokens by strike (outer-aligned, so a missing CE/PE leg stays NaN)
+        ce = filtered_df[filtered_df['instrument_type'] == 'CE'].set_index('strike')['instrument_token']
+        pe = filtered_df[filtered_df['instrument_type'] == 'PE'].set_index('strike')['instrument_token']
+        template = pd.DataFrame({'CE': ce, 'PE': pe}).sort_index()
 
-        # 6. Merge Live Data back into DataFrame
-        ltp_list = []
-        oi_list = []
-        
-        for token in filtered_df['instrument_token']:
-            data = live_data.get(token, {})
-            # Kite sometimes returns quote key as string, sometimes int. 
-            # safe fetch logic
-            data = live_data.get(str(token)) or live_data.get(int(token)) or {}
-            
-            ltp_list.append(data.get('last_price', 0))
-            oi_list.append(data.get('oi', 0))
+        return filtered_df['instrument_token'].tolist(), template
 
-        filtered_df['LTP'] = ltp_list
-        filtered_df['OI'] = oi_list
+    @staticmethod
+    def _pick(live_data, token):
+        # Kite sometimes returns quote key as string, sometimes int. 
+        return live_data.get(str(token)) or live_data.get(int(token)) or {}
 
-        # 7. Pivot/Format for UI (Call vs Put)
-        ce_df = filtered_df[filtered_df['instrument_type'] == 'CE'][['strike', 'LTP', 'OI']].set_index('strike')
-        pe_df = filtered_df[filtered_df['instrument_type'] == 'PE'][['strike', 'LTP', 'OI']].set_index('strike')
-        
-        # Join on Strike
-        final_chain = ce_df.join(pe_df, lsuffix='_CE', rsuffix='_PE', how='outer').sort_index()
-        
-        # Rename columns for the UI
-        final_chain = final_chain.reset_index()
-        final_chain.columns = ['Strike Price', 'CE Price', 'CE OI', 'PE Price', 'PE OI']
-        
-        return final_chain
+    def _subscribe(self, key, chain):
+        """
+        Marks a chain window as viewed, starts the KiteTicker stream (again, if it gave up)
+        and keeps it subscribed, in LTP mode, to exactly the tokens of recently viewed windows.
+        """
+        now = time.time()
+        with self.sub_lock:
+            self.chain_token_cache[key] = chain
+            self.window_used[key] = now
+            # Windows left behind as ATM drifts or the expiry changes stop streaming
+            for k in [k for k, used in self.window_used.items() if now - used > WINDOW_IDLE_SECS]:
+                del self.window_used[k]
+                self.chain_token_cache.pop(k, None)
+            wanted = {int(t) for tokens, _ in self.chain_token_cache.values() for t in tokens}
+            new_tokens = list(wanted - self.subscribed)
+            stale_tokens = list(self.subscribed - wanted)
+            self.subscribed = wanted
+            for t in stale_tokens:
+                self.ticks.pop(t, None)
+
+            # Checked and created under the lock: the manager is shared by every session,
+            # and Kite limits websocket connections per API key
+            if self.ticker is None:
+                try:
+                    from kiteconnect import KiteTicker
+                    ticker = KiteTicker(self.api_key, self.access_token)
+                    ticker.on_ticks = self._on_ticks
+                    ticker.on_connect = self._on_connect
+                    ticker.on_close = self._on_close
+                    ticker.on_noreconnect = self._on_noreconnect
+                    ticker.connect(threaded=True)
+                    self.ticker = ticker # only once connect() didn't raise, so a failed start is retried
+                except Exception as e:
+                    print(f"Error starting ticker: {e}. Using REST prices.")
+                return # on_connect subscribes everything collected so far
+
+            ticker = self.ticker
+        if (new_tokens or stale_tokens) and ticker is not None and ticker.is_connected():
+            # The socket can drop between is_connected() and the send; KiteTicker then
+            # closes and re-raises. on_connect resubscribes everything, so just fall back to REST.
+            try:
+                if stale_tokens:
+                    ticker.unsubscribe(stale_tokens)
+                if new_tokens:
+                    ticker.subscribe(new_tokens)
+                    ticker.set_mode(ticker.MODE_LTP, new_tokens)
+            except Exception as e:
+                print(f"Error subscribing ticker tokens: {e}. Using REST prices.")
+
+    def _on_connect(self, ws, response):
+        # Also runs after auto-reconnects, so always (re)subscribe the full set
+        with self.sub_lock:
+            tokens = list(self.subscribed)
+        ws.subscribe(tokens)
+        ws.set_mode(ws.MODE_LTP, tokens)
+
+    def _on_ticks(self, ws, ticks):
+        self.ticks.update({t['instrument_token']: t for t in ticks})
+
+    def _on_close(self, ws, code, reason):
+        # Ticks stop flowing once the socket drops; don't serve them as live prices
+        if ws is not self.ticker:
+            return # a replaced/orphaned socket must not wipe the live stream's ticks
+        print(f"Ticker closed ({code}: {reason}). Using REST prices until it reconnects.")
+        self.ticks.clear()
+
+    def _on_noreconnect(self, ws):
+        # KiteTicker has given up retrying; let the next _subscribe start a fresh stream
+        if ws is not self.ticker:
+            return
+        print("Ticker stopped reconnecting. Using REST prices and restarting on next refresh.")
+        self.ticks.clear()
+        self.ticker = None
+
+    def _tick_ltps(self, tokens):
+        """LTPs from the websocket cache, or None if the socket is down or any token hasn't ticked yet."""
+        ticker = self.ticker
+        if ticker is None or not ticker.is_connected():
+            return None
+        ltps = {}
+        for t in tokens:
+            tick = self.ticks.get(int(t))
+            if tick is None:
+                return None
+            ltps[int(t)] = tick.get('last_price', 0)
+        return ltps
+
+    def _fetch_ltps(self, tokens):
+        """Last traded prices via the lightweight ltp() endpoint (token -> price)."""
+        live_data = self.kite.ltp(tokens)
+        return {int(t): self._pick(live_data, t).get('last_price', 0) for t in tokens}
+
+    def _fetch_ois(self, tokens):
+        """Open interest via full quote(), re-fetched only when stale or a new strike appears."""
+        stale = time.time() - self.oi_fetched_at >= OI_REFRESH_SECS
+        missing = any(int(t) not in self.oi_cache for t in tokens)
+        if stale or missing:
+            live_data = self.kite.quote(tokens)
+            self.oi_cache.update({int(t): self._pick(live_data, t).get('oi', 0) for t in tokens})
+            self.oi_fetched_at = time.time()
+        return self.oi_cache
 
     def _get_mock_option_chain(self, symbol, expiry_date):
         base = 24000 if symbol == "NIFTY" else 48000
@@ -0,0 +1,4 @@
+import pytz
+
+# Market timezone; every timestamp the app shows or persists is IST-aware
+IST = pytz.timezone('Asia/Kolkata')
@@ -1,76 +1,195 @@
 import streamlit as st
 import sqlite3
 import json
+import queue
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
+from market_time import IST
 
 DB_FILE = "kite_sim.db"
 
+@st.cache_resource
+def get_conn():
+    """Single process-wide SQLite connection (autocommit, WAL) shared across reruns and sessions."""
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+# The UI connection is shared by every session, so writes are serialized to keep
+# one session's BEGIN..COMMIT from swallowing another session's statements
+DB_LOCK = threading.RLock()
+
+@contextmanager
+def transaction():
+    """Runs a group of writes on the shared connection atomically (ROLLBACK on any error)."""
+    with DB_LOCK:
+        conn = get_conn()
+        conn.execute("BEGIN")
+        try:
+            yield conn
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+@st.cache_resource
+def init_db():
+    """Creates the schema once per process rather than on every rerun."""
+    conn = get_conn()
+    # User State Table (Snapshot)
+    conn.execute('''CREATE TABLE IF NOT EXISTS user_state (
+                username TEXT PRIMARY KEY,
+                balance REAL,
+                pnl REAL,
+                positions TEXT,
+                last_updated TIMESTAMP
+            )''')
+    # Trade History Table (Log)
+    conn.execute('''CREATE TABLE IF NOT EXISTS trade_logs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT,
+                action TEXT,
+                instrument TEXT,
+                qty INTEGER,
+                price REAL,
+                timestamp TIMESTAMP
+            )''')
+    # Open Positions Table (one row per instrument, upserted on each trade)
+    conn.execute('''CREATE TABLE IF NOT EXISTS positions (
+                username TEXT,
+                instrument TEXT,
+                qty INTEGER,
+                avg_price REAL,
+                ts TIMESTAMP,
+                PRIMARY KEY (username, instrument)
+            )''')
+    return True
+
+LOG_INSERT = "INSERT INTO trade_logs (username, action, instrument, qty, price, timestamp) VALUES (?, ?, ?, ?, ?, ?)"
+LOG_RETRY_SECS = 2 # pause before retrying a batch that failed to write
+LOG_FLUSH_TIMEOUT = 10 # how long reset_account waits for a user's queued rows
+
+# username -> rows queued but not yet written, so a reset waits on its own rows only
+LOG_PENDING = {}
+LOG_COND = threading.Condition()
+
+def _log_writer(log_q):
+    """Drains queued trade-log rows and writes each batch in a single transaction, retrying until it lands."""
+    conn = None # own connection so batch transactions don't interleave with the UI's
+    while True:
+        batch = [log_q.get()]
+        while True:
+            try:
+                batch.append(log_q.get_nowait())
+            except queue.Empty:
+                break
+        while True:
+            try:
+                if conn is None:
+                    conn = sqlite3.connect(DB_FILE)
+                with conn:
+                    conn.executemany(LOG_INSERT, batch)
+                break
+            except Exception as e:
+                # Keep the batch (and the thread) alive; a locked or unreachable DB is usually transient
+                print(f"Error writing trade logs: {e}. Retrying in {LOG_RETRY_SECS}s.")
+                if conn is not None:
+                    conn.close()
+                    conn = None
+                time.sleep(LOG_RETRY_SECS)
+        with LOG_COND:
+            for row in batch:
+                left = LOG_PENDING.get(row[0], 1) - 1
+                if left > 0:
+                    LOG_PENDING[row[0]] = left
+                else:
+                    LOG_PENDING.pop(row[0], None)
+            LOG_COND.notify_all()
+        time.sleep(0.5)
+
+@st.cache_resource
+def get_log_queue():
+    """Process-wide trade-log queue with its background writer thread (started once)."""
+    log_q = queue.Queue()
+    threading.Thread(target=_log_writer, args=(log_q,), daemon=True).start()
+    return log_q
+
 class WalletManager:
     def __init__(self, username):
         self.username = username
-        self._init_db()
+        init_db()
         self._load_user_data()
 
-    def _init_db(self):
-        with sqlite3.connect(DB_FILE) as conn:
-            c = conn.cursor()
-            # User State Table (Snapshot)
-            c.execute('''CREATE TABLE IF NOT EXISTS user_state (
-                        username TEXT PRIMARY KEY,
-                        balance REAL,
-                        pnl REAL,
-                        positions TEXT,
-                        last_updated TIMESTAMP
-                    )''')
-            # Trade History Table (Log)
-            c.execute('''CREATE TABLE IF NOT EXISTS trade_logs (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        username TEXT,
-                        action TEXT,
-                        instrument TEXT,
-                        qty INTEGER,
-                        price REAL,
-                        timestamp TIMESTAMP
-                    )''')
-            conn.commit()
-
     def _load_user_data(self):
         """Loads balance and positions from DB into Session State"""
         if 'balance' not in st.session_state:
-            with sqlite3.connect(DB_FILE) as conn:
-                c = conn.cursor()
-                c.execute("SELECT balance, pnl, positions FROM user_state WHERE username=?", (self.username,))
-                row = c.fetchone()
-                
-                if row:
-                    st.session_state.balance = row[0]
-                    st.session_state.pnl = row[1]
-                    try:
-                        st.session_state.positions = json.loads(row[2])
-                    except:
-                        st.session_state.positions = []
-                else:
-                    # New User Defaults
-                    st.session_state.balance = 100000.0
-                    st.session_state.pnl = 0.0
-                    st.session_state.positions = []
+            row = get_conn().execute("SELECT balance, pnl, positions FROM user_state WHERE username=?",
+                                     (self.username,)).fetchone()
+            
+            if row:
+                st.session_state.balance = row[0]
+                st.session_state.pnl = row[1]
+                if row[2]:
+                    self._migrate_positions_blob(row[2])
+                st.session_state.positions = self._load_positions()
+            else:
+                # New User Defaults
+                st.session_state.balance = 100000.0
+                st.session_state.pnl = 0.0
+                st.session_state.positions = []
+                with transaction():
                     self._save_state() # Create initial record
 
-    def _save_state(self):
-        """Persists current session state to DB"""
-        with sqlite3.connect(DB_FILE) as conn:
-            c = conn.cursor()
-            # Custom serializer for potential numpy types if casting missed somewhere
-            def default_serializer(obj):
-                if hasattr(obj, 'item'): # numpy types
-                    return obj.item()
-                raise TypeError(f"Type {type(obj)} not serializable")
-
-            pos_json = json.dumps(st.session_state.positions, default=default_serializer)
-            c.execute('''INSERT OR REPLACE INTO user_state (username, balance, pnl, positions, last_updated)
-                        VALUES (?, ?, ?, ?, ?)''', 
-                        (self.username, st.session_state.balance, st.session_state.pnl, pos_json, datetime.now()))
-            conn.commit()
+        # Instrument -> position lookup sharing the same dicts as the positions list
+        if 'positions_idx' not in st.session_state:
+            st.session_state.positions_idx = {p['instrument']: p for p in st.session_state.positions}
+
+    def _load_positions(self):
+        """Reads open positions for this user, in the order they were opened"""
+        rows = get_conn().execute("SELECT instrument, qty, avg_price, ts FROM positions WHERE username=? ORDER BY rowid",
+                                  (self.username,)).fetchall()
+        return [{
+            "instrument": instrument,
+            "type": "BUY",
+            "qty": qty,
+            "avg_price": avg_price,
+            "status": "OPEN",
+            "timestamp": ts
+        } for instrument, qty, avg_price, ts in rows]
+
+    def _migrate_positions_blob(self, pos_json):
+        """One-off move of the legacy JSON positions column into the positions table"""
+        try:
+            legacy = json.loads(pos_json)
+        except:
+            legacy = []
+        with transaction() as conn:
+            for pos in legacy:
+                self._save_position(pos)
+            conn.execute("UPDATE user_state SET positions=NULL WHERE username=?", (self.username,))
+
+    def _save_state(self, now=None):
+        """Persists balance and realized P&L (positions are saved per-row by _save_position). Call inside transaction()."""
+        get_conn().execute('''INSERT INTO user_state (username, balance, pnl, last_updated)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(username) DO UPDATE SET
+                        balance=excluded.balance, pnl=excluded.pnl, last_updated=excluded.last_updated''',
+                    (self.username, float(st.session_state.balance), float(st.session_state.pnl), now or datetime.now(IST)))
+
+    def _save_position(self, pos):
+        """Upserts a single position row, or deletes it once fully closed. Call inside transaction()."""
+        if pos['qty'] > 0:
+            get_conn().execute('''INSERT INTO positions (username, instrument, qty, avg_price, ts)
+                        VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT(username, instrument) DO UPDATE SET
+                            qty=excluded.qty, avg_price=excluded.avg_price''',
+                        (self.username, pos['instrument'], int(pos['qty']), float(pos['avg_price']), pos.get('timestamp')))
+        else:
+            get_conn().execute("DELETE FROM positions WHERE username=? AND instrument=?",
+                               (self.username, pos['instrument']))
 
     def get_balance(self):
         return st.session_state.balance
@@ -78,12 +197,21 @@ class WalletManager:
     def get_realized_pnl(self):
         return st.session_state.pnl
 
-    def execute_trade(self, type, instrument, quantity, price):
+    def execute_trade(self, type, instrument, quantity, price, now=None):
         """
         Executes a trade and saves state.
+        `now` lets the caller stamp the position, state and log rows with one shared timestamp.
         """
+        now = now or datetime.now(IST)
         success = False
         msg = ""
+
+        # Snapshot so a failed DB write can't leave session state ahead of the DB
+        prev_balance = st.session_state.balance
+        prev_pnl = st.session_state.pnl
+        prev_positions = list(st.session_state.positions)
+        prev_pos = st.session_state.positions_idx.get(instrument)
+        prev_pos_fields = dict(prev_pos) if prev_pos else None
         if type == "BUY":
             quantity = int(quantity)
             price = float(price)
@@ -93,7 +221,7 @@ class WalletManager:
                 st.session_state.balance -= cost
                 
                 # Check if we already have a position for this instrument
-                existing_pos = next((p for p in st.session_state.positions if p['instrument'] == instrument), None)
+                existing_pos = st.session_state.positions_idx.get(instrument)
                 
                 if existing_pos:
                     # Average Price Logic
@@ -102,14 +230,16 @@ class WalletManager:
                     existing_pos['qty'] = total_qty
                     existing_pos['avg_price'] = total_cost / total_qty
                 else:
-                    st.session_state.positions.append({
+                    existing_pos = {
                         "instrument": instrument,
                         "type": "BUY",
                         "qty": quantity,
                         "avg_price": price,
                         "status": "OPEN",
-                        "timestamp": datetime.now().isoformat()
-                    })
+                        "timestamp": now.isoformat()
+                    }
+                    st.session_state.positions.append(existing_pos)
+                    st.session_state.positions_idx[instrument] = existing_pos
                 success = True
                 msg = "Buy Order Executed"
             else:
@@ -121,7 +251,7 @@ class WalletManager:
             cost = quantity * price
             
             # Find the position
-            existing_pos = next((p for p in st.session_state.positions if p['instrument'] == instrument), None)
+            existing_pos = st.session_state.positions_idx.get(instrument)
             
             if not existing_pos:
                  return False, "No open position to sell."
@@ -143,23 +273,37 @@ class WalletManager:
             # Remove if closed completely
             if existing_pos['qty'] == 0:
                 st.session_state.positions.remove(existing_pos)
+                del st.session_state.positions_idx[instrument]
             
             success = True
             msg = f"Sold {quantity}. Realized P&L: {pnl_chunk:.2f}"
              
         if success:
-            self._save_state()
-            self._log_trade(type, instrument, quantity, price)
+            try:
+                # Balance and position land together or not at all
+                with transaction():
+                    self._save_state(now)
+                    self._save_position(existing_pos)
+            except Exception as e:
+                st.session_state.balance = prev_balance
+                st.session_state.pnl = prev_pnl
+                if prev_pos is not None:
+                    prev_pos.clear()
+                    prev_pos.update(prev_pos_fields)
+                st.session_state.positions = prev_positions
+                st.session_state.positions_idx = {p['instrument']: p for p in prev_positions}
+                return False, f"Trade not saved: {e}"
+
+            self._log_trade(type, instrument, quantity, price, now)
             return True, msg
             
         return False, msg
 
-    def _log_trade(self, action, instrument, qty, price):
-        with sqlite3.connect(DB_FILE) as conn:
-            c = conn.cursor()
-            c.execute("INSERT INTO trade_logs (username, action, instrument, qty, price, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
-                      (self.username, action, instrument, qty, price, datetime.now()))
-            conn.commit()
+    def _log_trade(self, action, instrument, qty, price, now):
+        # Written asynchronously by _log_writer; the trade itself doesn't wait on the log insert
+        with LOG_COND:
+            LOG_PENDING[self.username] = LOG_PENDING.get(self.username, 0) + 1
+        get_log_queue().put((self.username, action, instrument, qty, price, now))
 
     def update_pnl_heatmap(self, current_ltp_dict):
         """
@@ -167,39 +311,41 @@ class WalletManager:
         Only persists when trade happens or maybe on page unload (hard to catch).
         We will rely on session state for live P&L, db for hard state.
         """
+        # A plain single pass beats numpy here: portfolios are small and the
+        # array build/write-back would cost more than the arithmetic saves
         unrealized = 0.0
         for pos in st.session_state.positions:
-            inst = pos['instrument']
-            qty = pos['qty']
-            avg = pos['avg_price']
-            
-            ltp = current_ltp_dict.get(inst)
+            ltp = current_ltp_dict.get(pos['instrument'])
             
-            if ltp:
-                pos_pnl = (ltp - avg) * qty
+            # Missing, zero or NaN (one-sided strike) LTP keeps the last known P&L
+            if ltp and ltp == ltp:
+                ltp = float(ltp)
                 pos['current_price'] = ltp
-                pos['unrealized_pnl'] = pos_pnl
-                unrealized += pos_pnl
+                pos['unrealized_pnl'] = (ltp - pos['avg_price']) * pos['qty']
             else:
                 pos['unrealized_pnl'] = pos.get('unrealized_pnl', 0.0)
-                unrealized += pos.get('unrealized_pnl', 0.0)
+            unrealized += pos['unrealized_pnl']
                 
         return st.session_state.pnl + unrealized
 
     def reset_account(self):
         """Resets the user's account to initial state."""
+        # 0. This user's queued log rows must land first, or they'd outlive the DELETE below
+        with LOG_COND:
+            flushed = LOG_COND.wait_for(lambda: not LOG_PENDING.get(self.username), timeout=LOG_FLUSH_TIMEOUT)
+        if not flushed:
+            return False, "Trade history is still being saved. Try again in a moment."
+
         # 1. Reset Session State
         st.session_state.balance = 100000.0
         st.session_state.pnl = 0.0
         st.session_state.positions = []
+        st.session_state.positions_idx = {}
         
-        # 2. Reset DB State
-        self._save_state()
-        
-        # 3. Clear Logs
-        with sqlite3.connect(DB_FILE) as conn:
-            c = conn.cursor()
-            c.execute("DELETE FROM trade_logs WHERE username=?", (self.username,))
-            conn.commit()
+        # 2. Reset DB State + Clear Logs in one transaction
+        with transaction() as conn:
+            self._save_state()
+            conn.execute("DELETE FROM positions WHERE username=?", (self.username,))
+            conn.execute("DELETE FROM trade_logs WHERE username=?", (self.username,))
             
         return True, "Account Reset Successfully"